@@ -0,0 +1,172 @@
+import datetime
+import os
+import struct
+import threading
+import time
+import logging
+from typing import Optional
+
+_LOGGER = logging.getLogger(__name__)
+
+ACCOUNTING_PATH = "/data/accounting.bin"
+DAYS = 400  # slots in the rollup file, indexed by day ordinal
+
+# File layout: header, then one slot per day.
+# header: magic, version, slots
+_HEADER = struct.Struct("<4sII")
+# day: ordinal, valve open seconds, travel, seconds at posmax, direction reversals, motor starts
+_DAY = struct.Struct("<IdddII")
+_MAGIC = b"JTAC"
+_VERSION = 1
+
+class DayTotals:
+    __slots__ = ("ordinal", "open", "travel", "atmax", "reversals", "moves")
+
+    def __init__(self, ordinal: int, open: float = 0.0, travel: float = 0.0, atmax: float = 0.0,
+                 reversals: int = 0, moves: int = 0) -> None:
+        self.ordinal = ordinal
+        self.open = open
+        self.travel = travel
+        self.atmax = atmax
+        self.reversals = reversals
+        self.moves = moves
+
+    @property
+    def day(self) -> datetime.date:
+        return datetime.date.fromordinal(self.ordinal)
+
+class NullAccounting:
+    """Accounting used when nothing should be kept (replays, load tests)."""
+    def tick(self, now: float, pos: float, moving: int) -> None:
+        pass
+
+    def snapshot(self) -> Optional[DayTotals]:
+        return None
+
+    def maybe_flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+NULL_ACCOUNTING = NullAccounting()
+
+class Accounting:
+    """
+    Integrates valve open time, actuator travel, direction reversals and time at posmax
+    from the motor loop, and keeps one rollup per day in a fixed size file.
+    tick() is O(1); the file is only rewritten (atomically) every flush_interval seconds,
+    when the day changes and on close.
+    """
+    def __init__(self, options, path: str = ACCOUNTING_PATH, flush_interval: float = 600.0,
+                 wallclock=time.time) -> None:
+        self.path = path
+        self.flush_interval = flush_interval
+        self.wallclock = wallclock
+        self.openfrom = options["posmin"] + options["posmargin"]
+        self.maxfrom = options["posmax"] - options["posmargin"]
+        self._lock = threading.Lock()
+        self._data = self._load()
+        self._last: Optional[float] = None
+        self._lastpos = 0.0
+        self._lastmoving = 0
+        self._lastdir = 0
+        self._lastflush = time.monotonic()
+        self._start_day()
+
+    def _load(self) -> bytearray:
+        size = _HEADER.size + DAYS * _DAY.size
+        try:
+            with open(self.path, "rb") as f:
+                data = bytearray(f.read())
+            if len(data) == size and _HEADER.unpack_from(data, 0) == (_MAGIC, _VERSION, DAYS):
+                return data
+            _LOGGER.warning("Ignoring unrecognised accounting file %s", self.path)
+        except FileNotFoundError:
+            pass
+        data = bytearray(size)
+        _HEADER.pack_into(data, 0, _MAGIC, _VERSION, DAYS)
+        return data
+
+    def _offset(self, ordinal: int) -> int:
+        return _HEADER.size + (ordinal % DAYS) * _DAY.size
+
+    def _start_day(self) -> None:
+        today = datetime.date.fromtimestamp(self.wallclock())
+        ordinal = today.toordinal()
+        fields = _DAY.unpack_from(self._data, self._offset(ordinal))
+        # carry on from a restart earlier today, otherwise the slot is a year old (or empty)
+        self.today = DayTotals(*fields) if fields[0] == ordinal else DayTotals(ordinal)
+        midnight = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time())
+        self._next_day = midnight.timestamp()
+
+    def _store(self) -> None:
+        t = self.today
+        _DAY.pack_into(self._data, self._offset(t.ordinal), t.ordinal, t.open, t.travel, t.atmax, t.reversals, t.moves)
+
+    def tick(self, now: float, pos: float, moving: int) -> None:
+        """Called every motor loop with the loop clock, filtered position and direction (0 stopped)."""
+        with self._lock:
+            if self._last is not None:
+                dt = now - self._last
+                t = self.today
+                if pos > self.openfrom: t.open += dt
+                if pos >= self.maxfrom: t.atmax += dt
+                # only count travel while driving, so ADC jitter at rest doesn't add up
+                if moving != 0 or self._lastmoving != 0: t.travel += abs(pos - self._lastpos)
+                if moving != 0 and self._lastmoving == 0:
+                    t.moves += 1
+                    if self._lastdir != 0 and moving != self._lastdir: t.reversals += 1
+                    self._lastdir = moving
+            self._last = now
+            self._lastpos = pos
+            self._lastmoving = moving
+            if self.wallclock() >= self._next_day:
+                self._store()
+                self._start_day()
+                self._lastflush = 0.0  # write out yesterday on the next maybe_flush
+
+    def snapshot(self) -> DayTotals:
+        with self._lock:
+            t = self.today
+            return DayTotals(t.ordinal, t.open, t.travel, t.atmax, t.reversals, t.moves)
+
+    def maybe_flush(self) -> None:
+        if time.monotonic() - self._lastflush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Atomically replace the rollup file with the current totals."""
+        with self._lock:
+            self._store()
+            data = bytes(self._data)
+        self._lastflush = time.monotonic()
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError:
+            _LOGGER.exception("Unable to write accounting file %s", self.path)
+
+    def close(self) -> None:
+        self.flush()
+
+def open_accounting(options) -> "Accounting | NullAccounting":
+    """Build the daily accounting, or keep nothing if its file can't be read."""
+    try:
+        return Accounting(options, options.get("accounting_path", ACCOUNTING_PATH))
+    except OSError:
+        _LOGGER.exception("Unable to open accounting file, daily totals disabled")
+        return NULL_ACCOUNTING
+
+def read_days(path: str = ACCOUNTING_PATH):
+    """Yield the DayTotals kept in a rollup file, oldest first."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if _HEADER.unpack_from(data, 0) != (_MAGIC, _VERSION, DAYS):
+        raise ValueError(f"{path} is not an accounting file")
+    days = [DayTotals(*_DAY.unpack_from(data, _HEADER.size + n * _DAY.size)) for n in range(DAYS)]
+    yield from sorted((d for d in days if d.ordinal), key=lambda d: d.ordinal)
@@ -3,12 +3,12 @@ from typing import Optional
 import queue
 import logging
 
-from simple_pid import PID
-from pigpio_sht4x import SHT4x
-
 from mqtt import ClimateEntity, NumberEntity, MQTTClient, MQTTEntity
+from .hardware import Hardware
 from .motor import MoveThread
 from .threadinghelpers import SHUTDOWN_EV
+from .accounting import NULL_ACCOUNTING
+from .trace import NULL_RECORDER, MODES, PID_CHANNELS, CH_TEMP, CH_HUMID, CH_SETPOINT, CH_MODE, CH_POSITION, CH_KP, CH_KI, CH_KD
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -17,9 +17,40 @@ def adj_tunings(t, index, data):
     t[index] = float(data)
     return t[0], t[1], t[2]
 
+def build_pid(options, kp, ki, kd, setpoint, auto_mode=True, time_fn=time.monotonic):
+    """The PID configuration used by the controller, shared with the offline tuning tools."""
+    from simple_pid import PID
+    pid = PID(kp, ki, kd, setpoint=setpoint,
+              output_limits=(options["posmin"], options["posmax"]),
+              auto_mode=auto_mode, time_fn=time_fn)
+    # PID extra options.
+    pid.sample_time = options["updaterate"]  # set PID update rate UPDATE_RATE
+    pid.proportional_on_measurement = False
+    pid.differential_on_measurement = False
+    return pid
+
+def pid_state(pid) -> tuple:
+    """The PID's internal state, in the order of trace.PID_CHANNELS."""
+    return pid._integral, pid._last_error, pid._last_input, pid._last_output, pid._last_time
+
+def restore_pid_state(pid, integral, last_error, last_input, last_output, last_time) -> None:
+    """Put back state saved by pid_state (used by the replay driver)."""
+    pid._integral, pid._last_error, pid._last_input = integral, last_error, last_input
+    pid._last_output, pid._last_time = last_output, last_time
+
 class Controller:
-    def __init__(self, client:MQTTClient, options):
+    def __init__(self, client:MQTTClient, options, trace=NULL_RECORDER, hardware=None, clock=time.monotonic,
+                 accounting=NULL_ACCOUNTING):
+        """
+        Sets up the entities and PID only; devices are opened by start_hardware.
+        hardware and clock default to the real devices and time.monotonic,
+        the replay driver passes stand-ins so a recorded trace can be fed back in.
+        """
+        self.hardware = hardware if hardware is not None else Hardware()
         self.client = client
+        self.trace = trace
+        self.accounting = accounting
+        self.clock = clock
         self.manualposition = client.register_entity(NumberEntity("manualposition", "Manual Position", min_value=0, max_value=30000, 
                                                                 on_command=self.handle_set_position, value=0, unit="mm"))
         self.targetposition = client.register_entity(MQTTEntity("sensor", "targetposition", "Target Position", value=0, unit="mm"))
@@ -33,35 +64,48 @@ class Controller:
         self.desiredtemp = client.register_entity(MQTTEntity("sensor", "desiredtemp", "Desired Temp.", unit="°C", device_class="temperature"))
         self.actualtemp = client.register_entity(MQTTEntity("sensor", "actualtemperature", "Actual Temperature", unit="°C", device_class="temperature"))
         self.actualhumid = client.register_entity(MQTTEntity("sensor", "actualhumidity", "Actual Humidity", unit="%", device_class="humidity"))
+        # daily totals from the accounting, reset at midnight (only when there is accounting,
+        # otherwise they would sit at unknown; reportAccounting skips them too)
+        if accounting is not NULL_ACCOUNTING:
+            self.opentoday = client.register_entity(MQTTEntity("sensor", "opentoday", "Valve Open Today", unit="min", device_class="duration", state_class="total_increasing"))
+            self.posmaxtoday = client.register_entity(MQTTEntity("sensor", "posmaxtoday", "Time At Max Today", unit="min", device_class="duration", state_class="total_increasing"))
+            self.traveltoday = client.register_entity(MQTTEntity("sensor", "traveltoday", "Travel Today", unit="mm", state_class="total_increasing"))
+            self.movestoday = client.register_entity(MQTTEntity("sensor", "movestoday", "Moves Today", state_class="total_increasing"))
+            self.reversalstoday = client.register_entity(MQTTEntity("sensor", "reversalstoday", "Reversals Today", state_class="total_increasing"))
         self.climate = ClimateEntity("climate", "Climate", on_temp_command=self.handle_set_temp, on_mode_command=self.handle_set_mode, 
                                      min_temp=options.get("min_temp", 15.0), max_temp=options.get("max_temp", 30.0))
         client.register_entity(self.climate)
         
-        self.pid = PID(self.kp.getFloat(), self.ki.getFloat(), self.kd.getFloat(), setpoint=self.climate.getFloat(),
-                output_limits=(options["posmin"], options["posmax"]), 
-                auto_mode=True if self.climate.mode == "auto" or self.climate.mode == "heat" else False)
-        self.TEMP = SHT4x()
-        # PID extra options.
-        self.pid.sample_time = options["updaterate"]  # set PID update rate UPDATE_RATE
-        self.pid.proportional_on_measurement = False
-        self.pid.differential_on_measurement = False
+        self.pid = build_pid(options, self.kp.getFloat(), self.ki.getFloat(), self.kd.getFloat(), self.climate.getFloat(),
+                auto_mode=True if self.climate.mode == "auto" or self.climate.mode == "heat" else False,
+                time_fn=clock)
+        self.TEMP = None
         self.motorq = queue.Queue()
         self.controllerq = queue.Queue()
-        self.mover = MoveThread(self.motorq, self.controllerq, options)
-        self.mover.start()
+        self.mover = MoveThread(self.motorq, self.controllerq, options, trace=trace, hardware=self.hardware, clock=clock,
+                               accounting=accounting)
         self.schedule = options["schedule"]
         self.lograte = options["lograte"]
         self.currentsched = ""
         self.mode: str = "off"
+        self.temp: float = 0.0
+        self.humidity: float = 0.0
+        self.apos: int | None = None
+        self._pidtime = None
+        # loop stats for the metrics endpoint
+        self.steps = 0
+        self.step_seconds = 0.0
 
     def handle_set_temp(self, data):
         #expect json parsed data
+        self.trace.record(CH_SETPOINT, data)
         self.pid.setpoint = data
         self.climate.value = data
         self.desiredtemp.value = data
     
     def handle_set_mode(self, data):
         #expect string, it should be one of "off", "heat", or "auto"
+        if data in MODES: self.trace.record(CH_MODE, MODES.index(data))
         self.mode = data
         if self.mode in ["heat", "auto"]:
             self.pid.auto_mode = True
@@ -71,7 +115,9 @@ class Controller:
         
     def handle_set_position(self, data):
         #expect json parsed data
+        self.trace.record(CH_POSITION, data)
         if data > 0:
+            self.trace.state(CH_MODE, MODES.index("off"))
             self.climate.mode = "off"
             self.mode = "off"
             self.targetposition.value = data
@@ -79,14 +125,17 @@ class Controller:
     
     # (Kp, Ki, Kd) expect json parsed data
     def handle_set_proportional(self, data):
+        self.trace.record(CH_KP, data)
         self.pid.tunings = adj_tunings(self.pid.tunings, 0, data)
         self.kp.value = data
         
     def handle_set_integral(self, data):
+        self.trace.record(CH_KI, data)
         self.pid.tunings = adj_tunings(self.pid.tunings, 1, data)
         self.ki.value = data
     
     def handle_set_derivative(self, data):
+        self.trace.record(CH_KD, data)
         self.pid.tunings = adj_tunings(self.pid.tunings, 2, data)
         self.kd.value = data
     
@@ -110,62 +159,98 @@ class Controller:
         sched = self.fetchsched(currstamp)
         if sched:
             if sched["timestamp"] != self.currentsched:
+                self.trace.record(CH_SETPOINT, sched["temp"])
                 self.pid.setpoint = sched["temp"]
                 self.climate.value = sched["temp"]
                 self.currentsched = sched["timestamp"]
 
+    def start_hardware(self):
+        """Open the sensor and actuator devices."""
+        self.TEMP = self.hardware.sensor()
+        self.mover.open_devices()
+
+    def drain(self):
+        """Empty the queue of events from the motor thread."""
+        if not self.controllerq.empty():
+            try:
+                ev = self.controllerq.get_nowait()
+                size = 1
+                while ev:
+                    if ev[0] == "AP":
+                        self.apos = ev[1]
+                    size+=1
+                    ev = self.controllerq.get_nowait()
+                _LOGGER.debug("q size: %s", size)
+            except queue.Empty: pass
+
+    def step(self):
+        """Take a measurement and move towards the PID's new position."""
+        self.drain()
+        # measure
+        temp, humidity = self.TEMP.measurements
+        self.trace.record(CH_TEMP, temp)
+        self.trace.record(CH_HUMID, humidity)
+        self.temp = round(temp, 2)
+        self.humidity = round(humidity, 2)
+        # Do things...
+        newpos = self.pid(self.temp)
+        if self.pid._last_time != self._pidtime:
+            # the PID computed a new output, keep its state for trace snapshots
+            self._pidtime = self.pid._last_time
+            self.trace.states(dict(zip(PID_CHANNELS, pid_state(self.pid))))
+        if newpos is not None: newpos = round(newpos)
+        if self.mode != "off" and newpos is not None:
+            self.targetposition.value = newpos # store new location
+            # move to new setpoint
+            self.motorq.put(["P", newpos])
+
+    def report(self):
+        """Publish current stats and pick up schedule changes."""
+        self.climate.current_temperature = self.temp
+        self.climate.current_humidity = self.humidity
+        self.actualtemp.value = self.temp
+        self.actualhumid.value = self.humidity
+        if self.apos is not None: 
+            self.actualposition.value = self.apos
+            self.apos = None
+        # log PID component values:
+        components = self.pid.components
+        self.ap.value = round(components[0], 2)
+        self.ai.value = round(components[1], 2)
+        self.ad.value = round(components[2], 2)
+        self.checkSetSchedule()
+        self.reportAccounting()
+
+    def reportAccounting(self):
+        totals = self.accounting.snapshot()
+        if totals is None: return
+        self.opentoday.value = round(totals.open / 60, 1)
+        self.posmaxtoday.value = round(totals.atmax / 60, 1)
+        self.traveltoday.value = round(totals.travel)
+        self.movestoday.value = totals.moves
+        self.reversalstoday.value = totals.reversals
+        self.accounting.maybe_flush()
+
     def loop(self):
-        self.client.connect()
-        lastupdate = time.monotonic()
+        self.mover.start()
+        lastupdate = self.clock()
         lastschedcheck = lastupdate
-        apos: int | None = None
         try:
             while not SHUTDOWN_EV.is_set():
-                # process queue
-                if not self.controllerq.empty():
-                    try:
-                        ev = self.controllerq.get_nowait()
-                        size = 1
-                        while ev:
-                            if ev[0] == "AP":
-                                apos = ev[1]
-                            size+=1
-                            ev = self.controllerq.get_nowait()
-                        print(f"q size: {size}")
-                    except queue.Empty: pass
-                currentupdate = time.monotonic()
-                currentschedcheck = time.monotonic()
-                # measure
-                temp, humidity = self.TEMP.measurements
-                temp = round(temp, 2)
-                humidity = round(humidity, 2)
-                # Do things...
-                newpos = self.pid(temp)
-                if newpos is not None: newpos = round(newpos)
-                if self.mode != "off" and newpos is not None:
-                    self.targetposition.value = newpos # store new location
-                    # move to new setpoint
-                    self.motorq.put(["P", newpos])
+                currentupdate = self.clock()
+                self.step()
+                self.steps += 1
+                self.step_seconds = self.clock() - currentupdate
                 SHUTDOWN_EV.wait(max(0.5 - (currentupdate-lastupdate), 0)) # sleep at most 0.5 secs... shouldn't be off the PID period by more than 0.5... probs...
                 lastupdate = currentupdate
-                if (currentschedcheck - lastschedcheck > self.lograte):
+                if (currentupdate - lastschedcheck > self.lograte):
                     # Log stats...
-                    self.climate.current_temperature = temp
-                    self.climate.current_humidity = humidity
-                    self.actualtemp.value = temp
-                    self.actualhumid.value = humidity
-                    if apos is not None: 
-                        self.actualposition.value = apos
-                        apos = None
-                    # log PID component values:
-                    components = self.pid.components
-                    self.ap.value = round(components[0], 2)
-                    self.ai.value = round(components[1], 2)
-                    self.ad.value = round(components[2], 2)
-                    self.checkSetSchedule()
-                    lastschedcheck = currentschedcheck
+                    self.report()
+                    lastschedcheck = currentupdate
         except KeyboardInterrupt:
             SHUTDOWN_EV.set()
             _LOGGER.info("Keyboard interrupt, exiting...")
         _LOGGER.info("Main thread waiting for worker to finish...")
         self.mover.join(timeout=5)
+        self.trace.close()
+        self.accounting.close()
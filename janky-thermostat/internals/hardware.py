@@ -0,0 +1,28 @@
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+class Hardware:
+    """
+    The pigpio backed devices. Driver modules are only imported when a device is opened,
+    so the rest of the add-on (and the offline tools) can start without them.
+    """
+    @property
+    def i2c_error(self) -> type:
+        import pigpio
+        return pigpio.error
+
+    def sensor(self):
+        """Temperature and humidity sensor, with a measurements property."""
+        from pigpio_sht4x import SHT4x
+        return SHT4x()
+
+    def position(self):
+        """Actuator position ADC, with a value property."""
+        from pigpio_ads1115 import ADS1115
+        return ADS1115(mode="continuous")
+
+    def motors(self):
+        """Motor driver, with enable, disable, setSpeeds and motor2.setSpeed."""
+        from dual_mc33926 import motors
+        return motors
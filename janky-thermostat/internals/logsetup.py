@@ -0,0 +1,119 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from typing import Dict, Tuple, Union
+
+_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
+
+class StdoutFilter(logging.Filter):
+    def filter(self, record):
+        return record.levelno < logging.WARNING
+
+Site = Union[Tuple[str, int], Tuple[str, int, str]]
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `burst` messages through per `interval` seconds from each logging call site.
+    When the first argument is a string (usually a topic or entity name) it is part of the site,
+    so one busy topic doesn't hide messages about the others. Up to max_sites are kept apart
+    this way, after that new arguments share their call site's limit.
+    The number dropped is added to the next message from that site that gets through.
+    """
+    def __init__(self, burst: int = 5, interval: float = 10.0, max_sites: int = 1024) -> None:
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_sites = max_sites
+        self._lock = threading.Lock()
+        # site -> [window start, messages in window, suppressed, highest suppressed level]
+        self._sites: Dict[Site, list] = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        site = (record.pathname, record.lineno)
+        args = record.args
+        with self._lock:
+            if isinstance(args, tuple) and args and isinstance(args[0], str):
+                keyed = site + (args[0],)
+                if keyed in self._sites or len(self._sites) < self.max_sites:
+                    site = keyed
+            state = self._sites.get(site)
+            if state is None:
+                state = self._sites[site] = [now, 0, 0, logging.NOTSET]
+            if now - state[0] >= self.interval:
+                state[0] = now
+                state[1] = 0
+            if state[1] >= self.burst:
+                state[2] += 1
+                state[3] = max(state[3], record.levelno)
+                return False
+            state[1] += 1
+            suppressed = state[2]
+            state[2] = 0
+            state[3] = logging.NOTSET
+        if suppressed:
+            record.msg = f"{record.msg} (suppressed {suppressed} similar messages)"
+        return True
+
+    def pending(self) -> Dict[Site, Tuple[int, int]]:
+        """Suppressed counts that have not been reported yet, with the highest level among them."""
+        with self._lock:
+            return {site: (state[2], state[3]) for site, state in self._sites.items() if state[2]}
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records rather than blocking the caller when the queue is full."""
+    def __init__(self, q: queue.Queue) -> None:
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            record.msg = f"{record.msg} ({dropped} messages dropped, log output is too slow)"
+        return super().prepare(record)
+
+class LogPipeline:
+    """
+    Root logging set up so that callers only format records and put them on a queue
+    (QueueHandler.prepare runs on the calling thread): a QueueListener thread writes them
+    to stdout (INFO and DEBUG) and stderr (WARNING and above).
+    """
+    def __init__(self, level, maxsize: int = 10000, burst: int = 5, interval: float = 10.0) -> None:
+        # STDOUT handler for INFO and DEBUG
+        out_hdlr = logging.StreamHandler(sys.stdout)
+        out_hdlr.setLevel(logging.DEBUG)
+        out_hdlr.addFilter(StdoutFilter())
+        out_hdlr.setFormatter(logging.Formatter(_FORMAT))
+        # STDERR handler for WARNING and above
+        err_hdlr = logging.StreamHandler(sys.stderr)
+        err_hdlr.setLevel(logging.WARNING)
+        err_hdlr.setFormatter(logging.Formatter(_FORMAT))
+
+        self.ratelimit = RateLimitFilter(burst, interval)
+        self.handler = DroppingQueueHandler(queue.Queue(maxsize))
+        self.handler.addFilter(self.ratelimit)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, out_hdlr, err_hdlr, respect_handler_level=True)
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.handler)
+        self.listener.start()
+
+    def stop(self) -> None:
+        """Flush everything queued, then report outstanding suppressed counts."""
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        # straight to the output handlers: these must not be rate limited themselves, and go out
+        # at the level of what was suppressed so they show whenever those messages would have
+        for site, (count, level) in self.ratelimit.pending().items():
+            record = logging.LogRecord(__name__, level, site[0], site[1], "suppressed %s similar messages from %s",
+                                       (count, ":".join(map(str, site))), None)
+            self.listener.handle(record)
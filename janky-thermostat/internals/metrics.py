@@ -0,0 +1,92 @@
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Callable, List, Optional, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+METRICS_PORT = 9101
+
+class Metrics:
+    """
+    Prometheus style metrics, read from their sources only when scraped.
+    Each metric is a callback, so nothing is done on the control loops between scrapes.
+    """
+    def __init__(self, prefix: str = "janky_") -> None:
+        self.prefix = prefix
+        self._metrics: List[Tuple[str, str, str, Callable[[], Optional[float]]]] = []
+
+    def counter(self, name: str, help: str, fn: Callable[[], Optional[float]]) -> None:
+        self._metrics.append((self.prefix + name, "counter", help, fn))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], Optional[float]]) -> None:
+        self._metrics.append((self.prefix + name, "gauge", help, fn))
+
+    def render(self) -> str:
+        lines = []
+        for name, kind, help, fn in self._metrics:
+            try:
+                value = fn()
+            except Exception:
+                _LOGGER.exception("Error reading metric %s", name)
+                continue
+            if value is None:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+def controller_metrics(control) -> Metrics:
+    """Metrics for a Controller, its MoveThread and its MQTTClient."""
+    m = Metrics()
+    pid, mover, client = control.pid, control.mover, control.client
+    m.gauge("setpoint_celsius", "PID setpoint", lambda: pid.setpoint)
+    m.gauge("temperature_celsius", "Last measured temperature", lambda: control.temp)
+    m.gauge("humidity_percent", "Last measured humidity", lambda: control.humidity)
+    m.gauge("pid_proportional", "PID proportional component", lambda: pid.components[0])
+    m.gauge("pid_integral", "PID integral component", lambda: pid.components[1])
+    m.gauge("pid_derivative", "PID derivative component", lambda: pid.components[2])
+    m.gauge("pid_auto", "1 when the PID is running", lambda: 1 if pid.auto_mode else 0)
+    m.gauge("actuator_target", "Position the actuator is moving to", lambda: mover.target)
+    m.gauge("actuator_position", "Filtered actuator position", lambda: mover.pos)
+    m.gauge("actuator_moving", "Actuator direction (0 when stopped)", lambda: mover.moving)
+    m.counter("motor_moves_total", "Motor starts", lambda: mover.moves)
+    m.counter("i2c_errors_total", "pigpio errors reading the actuator position", lambda: mover.i2c_errors)
+    m.counter("motor_loops_total", "Motor control loop iterations", lambda: mover.steps)
+    m.counter("controller_loops_total", "Controller loop iterations", lambda: control.steps)
+    m.gauge("controller_step_seconds", "Time taken by the last controller iteration, excluding the sleep", lambda: control.step_seconds)
+    m.counter("mqtt_publishes_total", "MQTT messages sent", lambda: client.publishes)
+    m.counter("mqtt_connects_total", "MQTT connections, including reconnects", lambda: client.connects)
+    m.counter("mqtt_disconnects_total", "MQTT disconnections", lambda: client.disconnects)
+    return m
+
+class _Handler(BaseHTTPRequestHandler):
+    metrics: Metrics
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _LOGGER.debug("metrics: " + format, *args)
+
+def start_metrics_server(metrics: Metrics, port: int = METRICS_PORT) -> Optional[HTTPServer]:
+    """Serve metrics over HTTP from a daemon thread. Returns None if the port can't be bound."""
+    handler = type("MetricsHandler", (_Handler,), {"metrics": metrics})
+    try:
+        server = HTTPServer(("", port), handler)
+    except OSError:
+        _LOGGER.exception("Unable to serve metrics on port %s, metrics disabled", port)
+        return None
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    _LOGGER.info("Serving metrics on port %s", port)
+    return server
@@ -4,11 +4,9 @@ import copy
 import time
 import logging
 
-import pigpio
-from pigpio_ads1115 import ADS1115
-from dual_mc33926 import motors
-
 from .threadinghelpers import SHUTDOWN_EV
+from .trace import NULL_RECORDER, CH_ADC, CH_MOTOR, CH_TARGET, CH_FILTERED, CH_LASTMOVE, CH_REPORTED
+from .accounting import NULL_ACCOUNTING
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -16,7 +14,11 @@ def clamp(prev, value, minoffset, maxoffset):
     return max(prev-minoffset, min(value, prev+maxoffset))
 
 class MoveThread(threading.Thread):
-    def __init__(self, motorq: queue.Queue, controllerq: queue.Queue, options):
+    def __init__(self, motorq: queue.Queue, controllerq: queue.Queue, options,
+                 trace=NULL_RECORDER, hardware=None, clock=time.monotonic, accounting=NULL_ACCOUNTING):
+        """
+        Devices come from hardware (see internals.hardware) once open_devices is called.
+        """
         super().__init__()
         self.motorq = motorq
         self.controllerq = controllerq
@@ -24,71 +26,125 @@ class MoveThread(threading.Thread):
         self.moving = 0
         self.offset = 4
         self.settings = copy.deepcopy(options)
-        self.POS = ADS1115(mode="continuous")
+        self.trace = trace
+        self.accounting = accounting
+        self.clock = clock
+        self.hardware = hardware
+        self.POS = None
+        self.motors = None
+        self.i2c_error: type = Exception
         self.UP = self.settings["updir"]
         self.DOWN = self.UP * -1
         self.STOP = 0
-    
+        self.pos = 0
+        self.lastmove = 0.0
+        self.reportpositiontime = 0.0
+        # stats for the metrics endpoint
+        self.moves = 0
+        self.steps = 0
+        self.i2c_errors = 0
+
+    def open_devices(self):
+        self.i2c_error = self.hardware.i2c_error
+        self.POS = self.hardware.position()
+        self.motors = self.hardware.motors()
+
+    def setLastmove(self):
+        self.lastmove = self.clock()
+        self.trace.state(CH_LASTMOVE, self.lastmove)
+
+    def set_speed(self, speed: int):
+        self.trace.record(CH_MOTOR, speed)
+        if speed == 0: self.motors.setSpeeds(0, 0)
+        else:
+            self.moves += 1
+            self.motors.motor2.setSpeed(speed)
+
+    def prime(self):
+        """Read the starting position before the first step."""
+        self.pos = self.read_position()
+        self.setLastmove()
+        self.reportpositiontime = self.lastmove
+        self.trace.state(CH_REPORTED, self.reportpositiontime)
+
+    def read_position(self):
+        try: npos = self.POS.value
+        except self.i2c_error:
+            self.i2c_errors += 1
+            _LOGGER.error("pigpio i2c error (probably)")
+            #try again
+            try: npos = self.POS.value
+            except self.i2c_error:
+                self.i2c_errors += 1
+                _LOGGER.error("pigpio i2c error... again. (probably)")
+                npos = self.pos
+        self.trace.record(CH_ADC, npos)
+        return npos
+
+    def step(self) -> bool:
+        """Run one iteration of the control loop. Returns False when asked to exit."""
+        self.steps += 1
+        # check if new target
+        if not self.motorq.empty():
+            try: 
+                packet = self.motorq.get(False)
+                if packet[0] == "P":
+                    if packet[1] != self.target: self.trace.state(CH_TARGET, packet[1])
+                    self.target = packet[1]
+                elif packet[0] == "S": self.settings = packet[1]
+            except queue.Empty: pass
+            if self.target == -2: return False
+        # current pos
+        npos = self.read_position()
+        pos = self.pos
+
+        # hectic filtering (lol why am I this jank)
+        if self.moving == self.UP:
+            pos = clamp(pos, npos, -(self.offset-1), self.offset)
+        elif self.moving == self.DOWN:
+            pos = clamp(pos, npos, self.offset, -(self.offset-1))
+        else:
+            pos = clamp(pos, npos, 5, 5)
+        self.pos = pos
+        self.trace.state(CH_FILTERED, pos)
+        
+        #print(self.target, round(pos), npos)
+        # TODO: Have movement timeout so not just attempting to move forever... first attempt higher speed, then bail
+        # seems too hard 'cuz potential changing directions I don't want to deal with it. When I change to actual motor instead of
+        # linear actuator this problem will go away 'cuz hopefully stalling won't be an issue.
+        if (self.clock() - self.reportpositiontime > 2):
+            self.controllerq.put(("AP", pos))
+            self.reportpositiontime = self.clock()
+            self.trace.state(CH_REPORTED, self.reportpositiontime)
+        #print(self.settings)
+        if self.target != -1:
+            if (self.moving == self.UP or self.moving == self.STOP) and pos < self.target - self.settings["posmargin"]:
+                if self.moving == self.STOP and self.clock() - self.lastmove > 2: 
+                    if self.moving != self.UP: self.set_speed(int(self.UP*self.settings["speed"])) # go UP
+                    self.moving = self.UP
+                if self.moving == self.DOWN: self.setLastmove()
+            elif (self.moving == self.DOWN or self.moving == self.STOP) and pos > self.target + self.settings["posmargin"]:
+                if self.moving == self.STOP and self.clock() - self.lastmove > 2: 
+                    if self.moving != self.DOWN: self.set_speed(int(self.DOWN*self.settings["speed"])) # go DOWN
+                    self.moving = self.DOWN
+                if self.moving == self.DOWN: self.setLastmove()
+            else: # also stop
+                if self.moving != self.STOP: self.set_speed(0)
+                self.moving = self.STOP
+        self.accounting.tick(self.clock(), pos, self.moving)
+        return True
+
     def run(self):
-        motors.enable()
-        pos = self.POS.value
-        lastmove = time.monotonic()
-        reportpositiontime = lastmove
+        self.motors.enable()
+        self.prime()
         try:
             while not SHUTDOWN_EV.is_set():
-                # check if new target
-                if not self.motorq.empty():
-                    try: 
-                        packet = self.motorq.get(False)
-                        if packet[0] == "P": self.target = packet[1]
-                        elif packet[0] == "S": self.settings = packet[1]
-                    except queue.Empty: pass
-                    if self.target == -2: break
-                # current pos
-                try: npos = self.POS.value
-                except pigpio.error:
-                    _LOGGER.error("pigpio i2c error (probably)")
-                    #try again
-                    try: npos = self.POS.value
-                    except pigpio.error:
-                        _LOGGER.error("pigpio i2c error... again. (probably)")
-                        npos = pos
-
-                # hectic filtering (lol why am I this jank)
-                if self.moving == self.UP:
-                    pos = clamp(pos, npos, -(self.offset-1), self.offset)
-                elif self.moving == self.DOWN:
-                    pos = clamp(pos, npos, self.offset, -(self.offset-1))
-                else:
-                    pos = clamp(pos, npos, 5, 5)
-                
-                #print(self.target, round(pos), npos)
-                # TODO: Have movement timeout so not just attempting to move forever... first attempt higher speed, then bail
-                # seems too hard 'cuz potential changing directions I don't want to deal with it. When I change to actual motor instead of
-                # linear actuator this problem will go away 'cuz hopefully stalling won't be an issue.
-                if (time.monotonic() - reportpositiontime > 2):
-                    self.controllerq.put(("AP", pos))
-                    reportpositiontime = time.monotonic()
-                #print(self.settings)
-                if self.target != -1:
-                    if (self.moving == self.UP or self.moving == self.STOP) and pos < self.target - self.settings["posmargin"]:
-                        if self.moving == self.STOP and time.monotonic() - lastmove > 2: 
-                            if self.moving != self.UP: motors.motor2.setSpeed(int(self.UP*self.settings["speed"])) # go UP
-                            self.moving = self.UP
-                        if self.moving == self.DOWN: lastmove = time.monotonic()
-                    elif (self.moving == self.DOWN or self.moving == self.STOP) and pos > self.target + self.settings["posmargin"]:
-                        if self.moving == self.STOP and time.monotonic() - lastmove > 2: 
-                            if self.moving != self.DOWN: motors.motor2.setSpeed(int(self.DOWN*self.settings["speed"])) # go DOWN
-                            self.moving = self.DOWN
-                        if self.moving == self.DOWN: lastmove = time.monotonic()
-                    else: # also stop
-                        if self.moving != self.STOP: motors.setSpeeds(0, 0)
-                        self.moving = self.STOP
+                if not self.step(): break
                 if self.moving != 0: SHUTDOWN_EV.wait(0.02)
                 else: SHUTDOWN_EV.wait(0.2)
             _LOGGER.info("Exiting motor control loop...")
         finally:
             # Stop the motors, even if there is an exception
             # or the user presses Ctrl+C to kill the process.
-            motors.setSpeeds(0, 0)
-            motors.disable()
+            self.motors.setSpeeds(0, 0)
+            self.motors.disable()
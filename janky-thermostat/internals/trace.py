@@ -0,0 +1,182 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import logging
+from typing import Iterator, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+TRACE_PATH = "/data/trace.bin"
+
+# Channels. Values are always stored as doubles, modes as their index in MODES.
+CH_TEMP = 1        # SHT4x temperature reading (°C)
+CH_HUMID = 2       # SHT4x humidity reading (%)
+CH_ADC = 3         # ADS1115 position sample (raw, before filtering)
+CH_SETPOINT = 10   # setpoint change (MQTT command or schedule)
+CH_MODE = 11       # mode command
+CH_POSITION = 12   # manual position command
+CH_KP = 13
+CH_KI = 14
+CH_KD = 15
+CH_MOTOR = 20      # speed passed to the motor driver (0 is stop)
+CH_OPEN = 30       # recorder opened, a new run starts; value is wall clock minus loop clock
+CH_SNAPSHOT = 31   # control state follows; value is how many STATE records
+# Snapshot only, the loop state needed to pick a replay up part way through a run.
+CH_TARGET = 40     # target the motor thread is moving to
+CH_FILTERED = 41   # motor thread's filtered position
+CH_LASTMOVE = 42   # when the motor last stopped (loop clock)
+CH_REPORTED = 43   # when the position was last reported (loop clock)
+CH_PID_INTEGRAL = 50
+CH_PID_ERROR = 51
+CH_PID_INPUT = 52
+CH_PID_OUTPUT = 53
+CH_PID_TIME = 54
+PID_CHANNELS = (CH_PID_INTEGRAL, CH_PID_ERROR, CH_PID_INPUT, CH_PID_OUTPUT, CH_PID_TIME)
+STATE = 100        # snapshot records are STATE + channel
+
+# Control state that is only recorded when it changes, so it is re-recorded in a snapshot
+# every 1/SNAPSHOTS of the ring (at the next motor step): after a wrap the oldest surviving
+# snapshot seeds a replay.
+# Snapshots are written in this order, the PID last so it is seeded after the mode.
+STATE_CHANNELS = (CH_MODE, CH_SETPOINT, CH_KP, CH_KI, CH_KD, CH_MOTOR,
+                  CH_TARGET, CH_FILTERED, CH_LASTMOVE, CH_REPORTED) + PID_CHANNELS
+SNAPSHOTS = 16
+
+CHANNEL_NAMES = {
+    CH_TEMP: "temp", CH_HUMID: "humid", CH_ADC: "adc",
+    CH_SETPOINT: "setpoint", CH_MODE: "mode", CH_POSITION: "position",
+    CH_KP: "kp", CH_KI: "ki", CH_KD: "kd",
+    CH_MOTOR: "motor", CH_OPEN: "open", CH_SNAPSHOT: "snapshot",
+    CH_TARGET: "target", CH_FILTERED: "filtered", CH_LASTMOVE: "lastmove", CH_REPORTED: "reported",
+    CH_PID_INTEGRAL: "pid integral", CH_PID_ERROR: "pid error", CH_PID_INPUT: "pid input",
+    CH_PID_OUTPUT: "pid output", CH_PID_TIME: "pid time",
+}
+CHANNEL_NAMES.update({STATE + ch: "state " + CHANNEL_NAMES[ch] for ch in STATE_CHANNELS})
+MODES = ["off", "auto", "heat"]
+
+# File layout: header, then a ring of fixed-width records.
+# header: magic, version, record capacity, total records ever written
+_HEADER = struct.Struct("<4sIQQ")
+# record: loop clock timestamp, channel, value
+_RECORD = struct.Struct("<dH6xd")
+_MAGIC = b"JTRC"
+_VERSION = 2
+
+class NullRecorder:
+    """Recorder used when tracing is disabled."""
+    def record(self, channel: int, value: float) -> None:
+        pass
+
+    def state(self, channel: int, value: float) -> None:
+        pass
+
+    def states(self, values: dict) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+NULL_RECORDER = NullRecorder()
+
+class TraceRecorder:
+    """
+    Appends (timestamp, channel, value) records to a memory mapped ring file.
+    The file never grows past size_bytes; once full the oldest records are overwritten.
+    Timestamps come from clock, which must be the clock the control loops run on so a
+    replay sees the same time steps (the wall clock can jump when NTP syncs). Each time the
+    file is opened a CH_OPEN record marks the start of a run and its offset to wall time.
+    The STATE_CHANNELS values are kept and re-recorded in a snapshot every 1/SNAPSHOTS of the ring,
+    just before the next ADC sample so it falls between two motor steps.
+    """
+    def __init__(self, path: str = TRACE_PATH, size_bytes: int = 16 * 1024 * 1024,
+                 clock=time.monotonic) -> None:
+        self.clock = clock
+        self.capacity = max((size_bytes - _HEADER.size) // _RECORD.size, 1)
+        filesize = _HEADER.size + self.capacity * _RECORD.size
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        existing = os.fstat(self._fd).st_size
+        if existing != filesize:
+            os.ftruncate(self._fd, filesize)
+        self._map: "mmap.mmap | None" = mmap.mmap(self._fd, filesize)
+        magic, version, capacity, count = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or version != _VERSION or capacity != self.capacity:
+            # new file, or resized: start fresh rather than mixing layouts
+            count = 0
+        self._count = count
+        self._state = {}
+        self._segment = max(self.capacity // SNAPSHOTS, len(STATE_CHANNELS) + 2)
+        self._next_snapshot = count
+        self._write_header()
+        self.record(CH_OPEN, time.time() - clock())
+        _LOGGER.info("Tracing to %s (%d records)", path, self.capacity)
+
+    def record(self, channel: int, value: float) -> None:
+        ts = self.clock()
+        with self._lock:
+            if self._map is None:
+                return  # closed while the MQTT or motor thread was still running
+            if channel == CH_ADC and self._count >= self._next_snapshot:
+                # snapshot at the start of a motor step, before its sample, so a replay
+                # seeded from it goes on to run that whole step
+                self._write(ts, CH_SNAPSHOT, len(self._state))
+                for ch in STATE_CHANNELS:
+                    if ch in self._state: self._write(ts, STATE + ch, self._state[ch])
+                self._next_snapshot = self._count + self._segment
+            self._write(ts, channel, value)
+            if channel in STATE_CHANNELS:
+                self._state[channel] = value
+            self._write_header()
+
+    def state(self, channel: int, value: float) -> None:
+        """Update control state that goes in snapshots without recording it now."""
+        with self._lock:
+            self._state[channel] = value
+
+    def states(self, values: dict) -> None:
+        """Update several state channels at once, so a snapshot never holds half of them."""
+        with self._lock:
+            self._state.update(values)
+
+    def _write(self, ts: float, channel: int, value: float) -> None:
+        offset = _HEADER.size + (self._count % self.capacity) * _RECORD.size
+        _RECORD.pack_into(self._map, offset, ts, channel, value)
+        self._count += 1
+
+    def _write_header(self) -> None:
+        _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, self.capacity, self._count)
+
+    def close(self) -> None:
+        """Flush and close the file. Later records are dropped rather than raising."""
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            os.close(self._fd)
+
+def open_recorder(options, clock=time.monotonic) -> "TraceRecorder | NullRecorder":
+    """Build the recorder configured by the trace_size option (MB, 0 disables)."""
+    size = int(options.get("trace_size", 0))
+    if size <= 0:
+        return NULL_RECORDER
+    try:
+        return TraceRecorder(options.get("trace_path", TRACE_PATH), size * 1024 * 1024, clock=clock)
+    except OSError:
+        _LOGGER.exception("Unable to open trace file, tracing disabled")
+        return NULL_RECORDER
+
+def read_trace(path: str) -> Iterator[Tuple[float, int, float]]:
+    """Yield (timestamp, channel, value) records from a trace file, oldest first."""
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, capacity, count = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError(f"{path} is not a trace file")
+    start = count - capacity if count > capacity else 0
+    for n in range(start, count):
+        offset = _HEADER.size + (n % capacity) * _RECORD.size
+        yield _RECORD.unpack_from(data, offset)
@@ -1,42 +1,22 @@
 # Run this at boot to continuously poll and adjust temp.
+import time
+STARTED = time.monotonic()
 import signal
-import logging
 import json
 import os
-import sys
-OPTIONS = json.load(open("/data/options.json"))
-
-class StdoutFilter(logging.Filter):
-    def filter(self, record):
-        return record.levelno < logging.WARNING
-root = logging.getLogger()
-root.setLevel(OPTIONS["loglevel"])
-# STDOUT handler for INFO and DEBUG
-out_hdlr = logging.StreamHandler(sys.stdout)
-out_hdlr.setLevel(logging.DEBUG)
-out_hdlr.addFilter(StdoutFilter())
-out_hdlr.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
-# STDERR handler for WARNING and above
-err_hdlr = logging.StreamHandler(sys.stderr)
-err_hdlr.setLevel(logging.WARNING)
-err_hdlr.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
-root.addHandler(out_hdlr)
-root.addHandler(err_hdlr)
-
-from mqtt.client import MQTTClient
+import logging
 
+from internals.logsetup import LogPipeline
 from internals.threadinghelpers import handle_shutdown
+from internals.trace import open_recorder
+from internals.accounting import open_accounting
 from internals.controller import Controller
+from mqtt.client import MQTTClient
 
-# Read env vars set by run.sh
-BROKER   = os.getenv("MQTT_BROKER", "localhost")
-p = os.getenv("MQTT_PORT", "1883").strip()
-if p == "": p = "1833"
-PORT     = int(p)
-USERNAME = os.getenv("MQTT_USERNAME") or None
-PASSWORD = os.getenv("MQTT_PASSWORD") or None
-
-CLIENT = MQTTClient(BROKER, port=PORT, username=USERNAME, password=PASSWORD)
+_LOGGER = logging.getLogger(__name__)
+# the startup breakdown is logged whatever the configured level, it is one line per start
+_STARTUP_LOGGER = logging.getLogger(__name__ + ".startup")
+_STARTUP_LOGGER.setLevel(logging.INFO)
 
 def processTimestamps(options):
     sch = []
@@ -50,12 +30,62 @@ def processTimestamps(options):
     options["schedule"] = sch
     options["schedule"].sort(key=lambda entry: entry["timestamp"])
 
+def load_options(path="/data/options.json"):
+    with open(path) as f:
+        options = json.load(f)
+    processTimestamps(options)
+    options["updir"] = int(options["updir"])
+    return options
+
+def make_client():
+    # Read env vars set by run.sh
+    broker   = os.getenv("MQTT_BROKER", "localhost")
+    p = os.getenv("MQTT_PORT", "1883").strip()
+    if p == "": p = "1833"
+    port     = int(p)
+    username = os.getenv("MQTT_USERNAME") or None
+    password = os.getenv("MQTT_PASSWORD") or None
+    return MQTTClient(broker, port=port, username=username, password=password)
+
+class StartupTimer:
+    """Collects how long each startup phase took."""
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.last = started
+        self.phases = []
+
+    def mark(self, name: str) -> None:
+        now = time.monotonic()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def log(self) -> None:
+        parts = ", ".join(f"{name} {secs * 1000:.0f}ms" for name, secs in self.phases)
+        _STARTUP_LOGGER.info("Startup took %.0fms: %s", (self.last - self.started) * 1000, parts)
+
 if __name__ == '__main__':
+    timer = StartupTimer(STARTED)
+    timer.mark("imports")
     signal.signal(signal.SIGTERM, handle_shutdown)
     signal.signal(signal.SIGINT,  handle_shutdown)
-    processTimestamps(OPTIONS)
-    OPTIONS["updir"] = int(OPTIONS["updir"])
-    control = Controller(CLIENT, OPTIONS)
-    control.loop()
-
-
+    options = load_options()
+    logs = LogPipeline(options["loglevel"])
+    # the listener is a daemon thread, so flush whatever is queued even if startup or the loop fails
+    try:
+        timer.mark("options")
+        client = make_client()
+        control = Controller(client, options, trace=open_recorder(options), accounting=open_accounting(options))
+        timer.mark("entities")
+        # MQTT connects and publishes discovery in paho's thread while the hardware comes up here
+        client.connect()
+        timer.mark("mqtt connect")
+        if options.get("metrics", False):
+            from internals.metrics import controller_metrics, start_metrics_server
+            start_metrics_server(controller_metrics(control))
+            timer.mark("metrics")
+        control.start_hardware()
+        timer.mark("hardware")
+        timer.log()
+        control.loop()
+    finally:
+        logs.stop()
@@ -6,6 +6,7 @@ from typing import List, Optional, Union, Any
 import paho.mqtt.client as mqtt
 import json
 import logging
+import time
 
 from .entity import MQTTEntity
 
@@ -25,8 +26,16 @@ class MQTTClient:
             self.client.username_pw_set(username, password)
         self.device: MQTTDevice = device
         self.entities: List[MQTTEntity] = []
+        # Counters for the metrics endpoint
+        self.publishes: int = 0
+        self.connects: int = 0
+        self.disconnects: int = 0
+        self._connect_started: float = 0.0
         # Paho callbacks
         self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_connect_fail = self._on_connect_fail
+        self.client.on_publish = self._on_publish
 
     def register_entity(self, entity: MQTTEntity) -> MQTTEntity:
         """Add an entity and subscribe to its command topic if defined."""
@@ -35,22 +44,42 @@ class MQTTClient:
         return entity
 
     def connect(self) -> None:
-        """Establish connection and start background loop."""
+        """Start the background loop, which connects (and reconnects) without blocking the caller."""
+        self._connect_started = time.monotonic()
+        self.client.connect_async(self.broker, self.port)
         self.client.loop_start()
-        self.client.connect(self.broker, self.port)
 
     def _on_connect(self,
                     client: mqtt.Client,
                     userdata: Any,
                     flags: dict,
                     rc: int) -> None:
-        _LOGGER.info("Connected to MQTT (%s:%s)", self.broker, self.port)
+        if rc != 0:
+            # paho keeps retrying in the background, so this is the only sign of a bad broker or login
+            _LOGGER.warning("MQTT connection to %s:%s refused: %s", self.broker, self.port, mqtt.connack_string(rc))
+            return
+        _LOGGER.info("Connected to MQTT (%s:%s) %.0fms after connect", self.broker, self.port,
+                     (time.monotonic() - self._connect_started) * 1000)
+        self.connects += 1
         # register client in entities and setup callbacks
         for entity in self.entities:
             entity._on_connect(self.client)
         # Publish discovery configs
         self.publish_discovery_configs()
 
+    def _on_connect_fail(self, client: mqtt.Client, userdata: Any) -> None:
+        _LOGGER.warning("Unable to connect to MQTT (%s:%s), retrying", self.broker, self.port)
+
+    def _on_disconnect(self, client: mqtt.Client, userdata: Any, rc: int) -> None:
+        if rc == 0:
+            _LOGGER.info("Disconnected from MQTT")
+        else:
+            _LOGGER.warning("Lost connection to MQTT (%s), reconnecting", mqtt.error_string(rc))
+        self.disconnects += 1
+
+    def _on_publish(self, client: mqtt.Client, userdata: Any, mid: int) -> None:
+        self.publishes += 1
+
     def publish_discovery_configs(self) -> None:
         for entity in self.entities:
             topic: str = entity.discovery_topic(self.device)
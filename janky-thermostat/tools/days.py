@@ -0,0 +1,23 @@
+"""
+Print the daily totals kept by the add-on as CSV, oldest day first.
+
+Run from the add-on directory:
+    python3 -m tools.days /data/accounting.bin
+"""
+import argparse
+import sys
+
+from internals.accounting import ACCOUNTING_PATH, read_days
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("accounting", nargs="?", default=ACCOUNTING_PATH, help="rollup file written by the add-on")
+    args = parser.parse_args(argv)
+
+    print("day,open_seconds,atmax_seconds,travel,moves,reversals")
+    for d in read_days(args.accounting):
+        print(f"{d.day.isoformat()},{d.open:.0f},{d.atmax:.0f},{d.travel:.0f},{d.moves},{d.reversals}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,376 @@
+"""
+MQTT load test: many simulated thermostats against one broker.
+
+Each instance is a real MQTTClient and Controller (entities, PID and command handlers)
+with stand-in hardware. By default they connect to a minimal in-process broker,
+which is restarted to cause reconnect storms:
+    python3 -m tools.loadtest -n 50 --storms 3 --flood 5000
+Against a real broker (reconnect storms then have to be caused by restarting it by hand):
+    python3 -m tools.loadtest -n 50 --broker localhost:1883 --flood 5000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import resource
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+from mqtt import MQTTClient, MQTTDevice
+from internals.controller import Controller
+from tools.replay import ReplayHardware
+
+_LOGGER = logging.getLogger(__name__)
+
+# Same defaults as config.yaml
+DEFAULT_OPTIONS = {
+    "schedule": [], "min_temp": 20.0, "max_temp": 28.0, "posmin": 1034, "posmax": 24600,
+    "posmargin": 50, "speed": 500000, "lograte": 10, "updaterate": 15, "updir": 1,
+}
+
+# MQTT 3.1.1 packet types
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+def topic_matches(filter: str, topic: str) -> bool:
+    f, t = filter.split("/"), topic.split("/")
+    for i, level in enumerate(f):
+        if level == "#":
+            return True
+        if i >= len(t) or (level != "+" and level != t[i]):
+            return False
+    return len(f) == len(t)
+
+def _encode_length(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+def _packet(kind: int, flags: int, body: bytes) -> bytes:
+    return bytes([kind << 4 | flags]) + _encode_length(len(body)) + body
+
+def _string(data: bytes, offset: int) -> Tuple[str, int]:
+    (n,) = struct.unpack_from("!H", data, offset)
+    return data[offset + 2:offset + 2 + n].decode("utf-8"), offset + 2 + n
+
+class _Session:
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.subscriptions: List[str] = []
+
+class LocalBroker:
+    """
+    Just enough of an MQTT 3.1.1 broker for the add-on: QoS 0/1 publish, retained messages,
+    subscribe with wildcards and keepalive. Runs its own event loop on a daemon thread.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.retained: Dict[str, bytes] = {}
+        self.sessions: List[_Session] = []
+        self.received = 0
+        self.sent = 0
+        self.discovery = 0
+        self.redelivered = 0  # retained messages sent on subscribe
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name="broker", daemon=True).start()
+        self._ready.wait()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        server = self._loop.run_until_complete(asyncio.start_server(self._serve, self.host, self.port))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    def restart(self) -> None:
+        """Drop every connection, keeping retained messages as Mosquitto's persistence would."""
+        def drop():
+            for session in self.sessions:
+                session.writer.close()
+            self.sessions.clear()
+        self._loop.call_soon_threadsafe(drop)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = _Session(writer)
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                length, shift = 0, 0
+                while True:
+                    (byte,) = await reader.readexactly(1)
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                if not self._handle(session, header[0] >> 4, header[0] & 0x0F, body):
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            writer.close()
+
+    def _handle(self, session: _Session, kind: int, flags: int, body: bytes) -> bool:
+        if kind == CONNECT:
+            self.sessions.append(session)
+            session.writer.write(_packet(CONNACK, 0, b"\x00\x00"))
+        elif kind == PUBLISH:
+            qos, retain = (flags >> 1) & 0x03, flags & 0x01
+            topic, offset = _string(body, 0)
+            if qos:
+                session.writer.write(_packet(PUBACK, 0, body[offset:offset + 2]))
+                offset += 2
+            payload = body[offset:]
+            self.received += 1
+            if topic.startswith("homeassistant/") and topic.endswith("/config"):
+                self.discovery += 1
+            if retain:
+                if payload: self.retained[topic] = payload
+                else: self.retained.pop(topic, None)
+            self._deliver(topic, payload)
+        elif kind == SUBSCRIBE:
+            packetid, offset = body[:2], 2
+            granted = bytearray()
+            new = []
+            while offset < len(body):
+                filter, offset = _string(body, offset)
+                offset += 1  # requested QoS, everything is delivered at QoS 0
+                session.subscriptions.append(filter)
+                new.append(filter)
+                granted.append(0)
+            session.writer.write(_packet(SUBACK, 0, packetid + bytes(granted)))
+            for topic, payload in list(self.retained.items()):
+                if any(topic_matches(f, topic) for f in new):
+                    self._send(session, topic, payload, retain=True)
+                    self.redelivered += 1
+        elif kind == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                filter, offset = _string(body, offset)
+                if filter in session.subscriptions:
+                    session.subscriptions.remove(filter)
+            session.writer.write(_packet(UNSUBACK, 0, body[:2]))
+        elif kind == PINGREQ:
+            session.writer.write(_packet(PINGRESP, 0, b""))
+        elif kind == DISCONNECT:
+            return False
+        return True
+
+    def _deliver(self, topic: str, payload: bytes) -> None:
+        for session in self.sessions:
+            if any(topic_matches(f, topic) for f in session.subscriptions):
+                self._send(session, topic, payload)
+
+    def _send(self, session: _Session, topic: str, payload: bytes, retain: bool = False) -> None:
+        encoded = topic.encode("utf-8")
+        session.writer.write(_packet(PUBLISH, 1 if retain else 0, struct.pack("!H", len(encoded)) + encoded + payload))
+        self.sent += 1
+
+class TrafficMonitor:
+    """Counts messages through an external broker by subscribing to everything."""
+    def __init__(self, host: str, port: int) -> None:
+        self.received = 0
+        self.discovery = 0
+        self.sent = None
+        self.redelivered = None
+        self.client = mqtt.Client(client_id=f"janky-loadtest-monitor-{random.getrandbits(32):08x}")
+        self.client.on_connect = lambda client, userdata, flags, rc: client.subscribe("#", qos=0)
+        self.client.on_message = self._on_message
+        self.client.connect(host, port)
+        self.client.loop_start()
+
+    def _on_message(self, client, userdata, msg) -> None:
+        if msg.retain:
+            return  # old retained messages replayed on subscribe, not new traffic
+        self.received += 1
+        if msg.topic.startswith("homeassistant/") and msg.topic.endswith("/config"):
+            self.discovery += 1
+
+class Instance:
+    """One simulated thermostat."""
+    def __init__(self, n: int, host: str, port: int, options: dict) -> None:
+        device = MQTTDevice(f"janky-thermostat-load{n:03d}", f"Janky Thermostat {n}", "Janky Thermo v1")
+        self.client = MQTTClient(host, port=port, device=device)
+        self.hardware = ReplayHardware()
+        self.control = Controller(self.client, dict(options), hardware=self.hardware)
+        self.control.start_hardware()
+        self.control.temp = 20.0 + random.random()
+        # count publishes as they are made, so a phase can wait for the broker to receive them all
+        self.published = 0
+        publish = self.client.client.publish
+        def counted(*args, **kwargs):
+            self.published += 1
+            return publish(*args, **kwargs)
+        self.client.client.publish = counted
+
+    @property
+    def settled(self) -> bool:
+        """True once every entity has loaded its retained state or published its default."""
+        return all(getattr(e, "_init_timer", None) is None and getattr(e, "_init_mode_timer", None) is None
+                   for e in self.client.entities)
+
+    def tick(self) -> None:
+        """Publish state the way the controller does every lograte seconds."""
+        self.control.temp = round(self.control.temp + random.uniform(-0.05, 0.05), 2)
+        self.control.humidity = 50.0
+        self.control.report()
+
+def wait_for(condition, timeout: float) -> Optional[float]:
+    """Seconds until condition() holds, or None on timeout."""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return time.monotonic() - start
+        time.sleep(0.01)
+    return None
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class Phase:
+    """Measures broker traffic and thread count over a block of the test."""
+    def __init__(self, name: str, stats) -> None:
+        self.name = name
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        self.received, self.sent = self.stats.received, self.stats.sent
+        self.peak_threads = threading.active_count()
+        return self
+
+    def sample(self) -> None:
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __exit__(self, *exc):
+        secs = max(time.monotonic() - self.start, 1e-9)
+        received = self.stats.received - self.received
+        line = f"{self.name:<14} {secs:7.2f}s  in {received:7d} ({received / secs:8.0f}/s)"
+        if self.sent is not None:
+            sent = self.stats.sent - self.sent
+            line += f"  out {sent:7d} ({sent / secs:8.0f}/s)"
+        print(line + f"  peak threads {self.peak_threads}")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--instances", type=int, default=20)
+    parser.add_argument("--broker", help="host:port of a real broker, instead of the in-process one")
+    parser.add_argument("--storms", type=int, default=2, help="broker restarts (in-process broker only)")
+    parser.add_argument("--flood", type=int, default=1000, help="commands to send in the command flood")
+    parser.add_argument("--ticks", type=int, default=5, help="rounds of state publishes from every instance")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--options", help="add-on options to run the instances with (JSON)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    # every instance warns about the dropped connection in each reconnect storm
+    logging.getLogger("mqtt.client").setLevel(logging.ERROR)
+
+    options = dict(DEFAULT_OPTIONS)
+    if args.options:
+        with open(args.options) as f:
+            options.update(json.load(f))
+        options["schedule"] = []
+        options["updir"] = int(options["updir"])
+
+    broker = None
+    if args.broker:
+        host, port = args.broker.rsplit(":", 1)
+        port = int(port)
+        stats = TrafficMonitor(host, port)
+    else:
+        broker = LocalBroker()
+        broker.start()
+        host, port = broker.host, broker.port
+        stats = broker
+
+    rss_before = rss_mb()
+    tracemalloc.start()
+    traced_before = tracemalloc.get_traced_memory()[0]
+    instances = [Instance(n, host, port, options) for n in range(args.instances)]
+    entities = sum(len(i.client.entities) for i in instances)
+    traced = (tracemalloc.get_traced_memory()[0] - traced_before) / args.instances
+    tracemalloc.stop()
+
+    print(f"{args.instances} instances, {entities} entities, broker {host}:{port}")
+    with Phase("connect", stats) as phase:
+        discovery = stats.discovery
+        for i in instances:
+            i.client.connect()
+        took = wait_for(lambda: phase.sample() or (all(i.client.connects for i in instances)
+                                                    and stats.discovery - discovery >= entities), args.timeout)
+    print(f"  all connected and discovered in {took:.2f}s" if took is not None else "  did not converge")
+    # a fresh broker has no retained state, so entities publish their defaults after 10s
+    took = wait_for(lambda: all(i.settled for i in instances), args.timeout)
+    print(f"  initial state settled in {took:.2f}s" if took is not None else "  initial state did not settle")
+
+    with Phase("state ticks", stats) as phase:
+        published = sum(i.published for i in instances)
+        for _ in range(args.ticks):
+            for i in instances:
+                i.tick()
+            phase.sample()
+        expected = sum(i.published for i in instances) - published
+        took = wait_for(lambda: phase.sample() or stats.received - phase.received >= expected, args.timeout)
+    print(f"  {expected} publishes received by the broker" if took is not None
+          else f"  broker received {stats.received - phase.received} of {expected} publishes")
+
+    for storm in range(args.storms if broker else 0):
+        with Phase(f"storm {storm + 1}", stats) as phase:
+            connects = [i.client.connects for i in instances]
+            discovery, redelivered = stats.discovery, stats.redelivered
+            broker.restart()
+            took = wait_for(lambda: phase.sample() or (all(i.client.connects > c and i.settled for i, c in zip(instances, connects))
+                                                        and stats.discovery - discovery >= entities), args.timeout)
+        print(f"  reconnect storm converged in {took:.2f}s, {stats.redelivered - redelivered} retained state messages redelivered"
+              if took is not None else "  did not converge")
+    if args.storms and not broker:
+        print("reconnect storms need the in-process broker, restart the real broker by hand to measure them")
+
+    if args.flood:
+        flooder = mqtt.Client(client_id=f"janky-loadtest-flood-{random.getrandbits(32):08x}")
+        flooder.connect(host, port)
+        flooder.loop_start()
+        # paho drops QoS 0 publishes made before the CONNACK arrives
+        wait_for(flooder.is_connected, args.timeout)
+        # entities still waiting for their retained state echo their own publishes back as
+        # commands, which would muddle the flood, so let that finish first
+        wait_for(lambda: all(i.settled for i in instances), args.timeout)
+        final = 2.5
+        with Phase("command flood", stats) as phase:
+            for n in range(args.flood):
+                target = instances[n % len(instances)]
+                value = final if n >= args.flood - len(instances) else round(random.uniform(0.1, 5.0), 2)
+                flooder.publish(target.control.kp.command_topic, json.dumps(value), qos=0)
+            took = wait_for(lambda: phase.sample() or all(i.control.kp.value == final for i in instances), args.timeout)
+        stale = sum(i.control.kp.value != final for i in instances)
+        print(f"  {args.flood} commands handled in {took:.2f}s" if took is not None
+              else f"  {stale} instances did not end on the last command sent to them")
+        flooder.loop_stop()
+        flooder.disconnect()
+
+    print(f"memory per instance: {traced / 1024:.1f} KiB python heap, "
+          f"{(rss_mb() - rss_before) / args.instances:.2f} MiB peak RSS growth")
+    for i in instances:
+        i.client.client.loop_stop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+Feed a recorded trace back through Controller and MoveThread with hardware stand-ins.
+
+Run from the add-on directory:
+    python3 -m tools.replay /data/trace.bin --options /data/options.json
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from mqtt import MQTTClient
+from internals.controller import Controller, restore_pid_state
+from internals.trace import (read_trace, CHANNEL_NAMES, MODES, STATE, PID_CHANNELS, CH_TEMP, CH_HUMID, CH_ADC,
+                             CH_SETPOINT, CH_MODE, CH_POSITION, CH_KP, CH_KI, CH_KD, CH_MOTOR, CH_OPEN, CH_SNAPSHOT,
+                             CH_TARGET, CH_FILTERED, CH_LASTMOVE, CH_REPORTED)
+
+_LOGGER = logging.getLogger(__name__)
+
+class ReplayClock:
+    """Clock driven by the timestamps in the trace (the loop clock, time.monotonic when live)."""
+    def __init__(self, now: float) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+class ReplaySensor:
+    """Stands in for the SHT4x."""
+    def __init__(self) -> None:
+        self.temp = 0.0
+        self.humidity = 0.0
+
+    @property
+    def measurements(self) -> Tuple[float, float]:
+        return self.temp, self.humidity
+
+class ReplayPosition:
+    """Stands in for the ADS1115."""
+    def __init__(self) -> None:
+        self.value = 0
+
+class _ReplayMotor:
+    def __init__(self, calls: List[int]) -> None:
+        self.calls = calls
+
+    def setSpeed(self, speed: int) -> None:
+        self.calls.append(speed)
+
+class ReplayMotors:
+    """Stands in for dual_mc33926.motors, keeping every speed it was given."""
+    def __init__(self) -> None:
+        self.calls: List[int] = []
+        self.motor2 = _ReplayMotor(self.calls)
+
+    def setSpeeds(self, m1: int, m2: int) -> None:
+        self.calls.append(m2)
+
+    def enable(self) -> None:
+        pass
+
+    def disable(self) -> None:
+        pass
+
+class ReplayHardware:
+    """Stand-ins for internals.hardware.Hardware, set from the trace."""
+    i2c_error = OSError
+
+    def __init__(self) -> None:
+        self._sensor = ReplaySensor()
+        self._position = ReplayPosition()
+        self._motors = ReplayMotors()
+
+    def sensor(self) -> ReplaySensor:
+        return self._sensor
+
+    def position(self) -> ReplayPosition:
+        return self._position
+
+    def motors(self) -> ReplayMotors:
+        return self._motors
+
+@dataclass
+class ReplayResult:
+    """
+    Motor commands as (motor step, speed), recorded and replayed. Steps are counted by ADC
+    samples from the start of the replay, so a command a step late doesn't match.
+    """
+    records: int = 0
+    expected: List[Tuple[int, int]] = field(default_factory=list)
+    actual: List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def first_divergence(self) -> Optional[int]:
+        for n, (exp, act) in enumerate(zip(self.expected, self.actual)):
+            if exp != act:
+                return n
+        if len(self.expected) != len(self.actual):
+            return min(len(self.expected), len(self.actual))
+        return None
+
+def seed(control: Controller, state: Dict[int, float]) -> None:
+    """Apply a snapshot to a fresh Controller, so a wrapped trace picks up where it starts."""
+    if CH_MODE in state:
+        control.handle_set_mode(MODES[int(state[CH_MODE])])
+    for channel, handler in ((CH_SETPOINT, control.handle_set_temp), (CH_KP, control.handle_set_proportional),
+                             (CH_KI, control.handle_set_integral), (CH_KD, control.handle_set_derivative)):
+        if channel in state:
+            handler(state[channel])
+    mover = control.mover
+    if CH_MOTOR in state:
+        # speed has the sign of the direction the motor was moving
+        mover.moving = (state[CH_MOTOR] > 0) - (state[CH_MOTOR] < 0)
+    mover.target = state.get(CH_TARGET, mover.target)
+    mover.pos = state.get(CH_FILTERED, mover.pos)
+    mover.lastmove = state.get(CH_LASTMOVE, mover.lastmove)
+    mover.reportpositiontime = state.get(CH_REPORTED, mover.reportpositiontime)
+    if all(ch in state for ch in PID_CHANNELS):
+        restore_pid_state(control.pid, *(state[ch] for ch in PID_CHANNELS))
+
+def replay(path: str, options: dict) -> ReplayResult:
+    """Replay a trace as fast as possible and collect recorded vs replayed motor commands."""
+    records = list(read_trace(path))
+    # the loop clock restarts with the add-on, so only replay the latest run
+    opens = [n for n, record in enumerate(records) if record[1] == CH_OPEN]
+    if opens:
+        records = records[opens[-1]:]
+    # start from the first snapshot, so a wrapped trace starts from known control state
+    snapshots = [n for n, record in enumerate(records) if record[1] == CH_SNAPSHOT]
+    records = records[snapshots[0]:] if snapshots else []
+    result = ReplayResult(records=len(records))
+    if not records:
+        return result
+    options = dict(options)
+    # schedule changes are in the trace as setpoint records
+    options["schedule"] = []
+    options["updir"] = int(options["updir"])
+    clock = ReplayClock(records[0][0])
+    hardware = ReplayHardware()
+    sensor, position, motors = hardware.sensor(), hardware.position(), hardware.motors()
+    control = Controller(MQTTClient("localhost"), options, hardware=hardware, clock=clock)
+    control.start_hardware()
+    mover = control.mover
+    primed = False
+    handlers = {
+        CH_SETPOINT: control.handle_set_temp,
+        CH_POSITION: control.handle_set_position,
+        CH_KP: control.handle_set_proportional,
+        CH_KI: control.handle_set_integral,
+        CH_KD: control.handle_set_derivative,
+    }
+    seeding, state, step = 0, {}, 0
+    for ts, channel, value in records:
+        clock.now = ts
+        if channel == CH_SNAPSHOT:
+            # only the first snapshot seeds, later ones repeat state the replay already has
+            seeding = int(value) if not state else 0
+        elif channel >= STATE:
+            if seeding:
+                state[channel - STATE] = value
+                seeding -= 1
+                if not seeding:
+                    seed(control, state)
+                    # the filtered position carries on from the snapshot rather than a fresh read
+                    primed = CH_FILTERED in state
+        elif channel == CH_TEMP:
+            sensor.temp = value
+        elif channel == CH_HUMID:
+            # humidity is recorded after temperature, right before the PID runs
+            sensor.humidity = value
+            control.step()
+        elif channel == CH_ADC:
+            position.value = value
+            step += 1
+            if primed:
+                mover.step()
+                result.actual.extend((step, speed) for speed in motors.calls[len(result.actual):])
+            else:
+                mover.prime()
+                primed = True
+        elif channel == CH_MODE:
+            control.handle_set_mode(MODES[int(value)])
+        elif channel == CH_MOTOR:
+            result.expected.append((step, int(value)))
+        elif channel in handlers:
+            handlers[channel](value)
+    return result
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="trace file recorded by the add-on")
+    parser.add_argument("--options", default="/data/options.json", help="add-on options the trace was recorded with")
+    parser.add_argument("--dump", action="store_true", help="print the trace as CSV instead of replaying it")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.dump:
+        offset = None  # unknown until the run's open record, which may have been overwritten
+        print("timestamp,wallclock,channel,value")
+        for ts, channel, value in read_trace(args.trace):
+            if channel == CH_OPEN: offset = value
+            wall = "" if offset is None else time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts + offset))
+            print(f"{ts:.3f},{wall},{CHANNEL_NAMES.get(channel, channel)},{value}")
+        return 0
+
+    with open(args.options) as f:
+        options = json.load(f)
+    result = replay(args.trace, options)
+    print(f"records: {result.records}  motor commands recorded: {len(result.expected)}  replayed: {len(result.actual)}")
+    n = result.first_divergence
+    if n is None:
+        print("replay matches recording")
+        return 0
+    expected = result.expected[n] if n < len(result.expected) else None
+    actual = result.actual[n] if n < len(result.actual) else None
+    print(f"diverged at motor command #{n} (step, speed): recorded {expected}, replayed {actual}")
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""
+Offline PID parameter sweep over a recorded trace.
+
+First fit a room model to a trace recorded by the add-on:
+    python3 -m tools.sweep fit /data/trace.bin room.json --options /data/options.json
+then simulate the controller's PID against it over a grid (or random sample) of settings:
+    python3 -m tools.sweep sweep /data/trace.bin room.json --options /data/options.json \\
+        --kp 0.5:4:8 --ki 0.1,0.5,1.2 --posmargin 25:100:4
+
+Ranges are either comma separated values or start:stop:count. Settings that are not
+given are taken from the options. Results are ranked by overshoot, settling time and
+actuator travel. Requires numpy.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from internals.controller import build_pid
+from internals.trace import read_trace, STATE, CH_OPEN, CH_TEMP, CH_ADC, CH_SETPOINT, CH_MOTOR
+
+PARAMS = ["kp", "ki", "kd", "posmargin", "speed", "updaterate"]
+INT_PARAMS = {"updaterate"}  # int(1,3600) in the add-on schema
+DEFAULT_TUNINGS = {"kp": 1.5, "ki": 1.2, "kd": 1.1}  # same defaults as the controller's entities
+MOTOR_REST = 2.0  # seconds MoveThread waits after stopping before it moves again
+
+def load_history(path: str) -> Dict[str, np.ndarray]:
+    """Split a trace into (times, values) arrays per channel of interest."""
+    channels: Dict[int, List[Tuple[float, float]]] = {CH_TEMP: [], CH_ADC: [], CH_SETPOINT: [], CH_MOTOR: []}
+    for ts, channel, value in read_trace(path):
+        if channel == CH_OPEN:
+            # the loop clock restarts with the add-on, so only the latest run is used
+            for samples in channels.values(): samples.clear()
+        # snapshots repeat the setpoint and motor speed, which may be all that is left of them after a wrap
+        if channel - STATE in (CH_SETPOINT, CH_MOTOR): channel -= STATE
+        if channel in channels:
+            channels[channel].append((ts, value))
+    history = {}
+    for channel, name in ((CH_TEMP, "temp"), (CH_ADC, "pos"), (CH_SETPOINT, "setpoint"), (CH_MOTOR, "motor")):
+        data = np.array(channels[channel], dtype=float).reshape(-1, 2)
+        history[name + "_t"] = data[:, 0]
+        history[name] = data[:, 1]
+    if len(history["temp"]) < 2 or len(history["pos"]) < 2:
+        raise ValueError(f"{path} does not have enough temperature and position samples")
+    return history
+
+def step_values(times: np.ndarray, values: np.ndarray, at: np.ndarray, default: float) -> np.ndarray:
+    """Sample a step function (value holds until the next change) at the given times."""
+    if len(times) == 0:
+        return np.full(len(at), default, dtype=float)
+    idx = np.searchsorted(times, at, side="right") - 1
+    return np.where(idx >= 0, values[np.clip(idx, 0, None)], default)
+
+def fit_model(history: Dict[str, np.ndarray], options: dict, dt: float = 60.0, maxlag: float = 1800.0) -> dict:
+    """
+    Fit dT/dt = gain*valve(t - lag) - loss*T + offset by least squares, where valve is
+    the actuator position scaled to 0..1 between posmin and posmax.
+    Also fit how far the actuator travels per second per unit of motor speed.
+    """
+    start = max(history["temp_t"][0], history["pos_t"][0])
+    stop = min(history["temp_t"][-1], history["pos_t"][-1])
+    grid = np.arange(start, stop, dt)
+    if len(grid) < 10:
+        raise ValueError("trace is too short to fit a model")
+    temp = np.interp(grid, history["temp_t"], history["temp"])
+    valve = (np.interp(grid, history["pos_t"], history["pos"]) - options["posmin"]) / (options["posmax"] - options["posmin"])
+    dtemp = np.diff(temp) / dt
+
+    best = None
+    for lag in range(0, int(maxlag // dt) + 1):
+        n = len(dtemp) - lag
+        if n < 10: break
+        X = np.column_stack([valve[:n], -temp[lag:lag + n], np.ones(n)])
+        y = dtemp[lag:lag + n]
+        coef, _, _, _ = np.linalg.lstsq(X, y, rcond=None)
+        err = float(np.mean((X @ coef - y) ** 2))
+        if best is None or err < best[0]:
+            best = (err, lag, coef)
+    err, lag, (gain, loss, offset) = best
+    if loss <= 0:
+        raise ValueError("fitted room does not lose heat, the trace probably does not cover enough heating cycles")
+
+    # actuator travel rate, from position samples taken while the motor was running
+    speed = step_values(history["motor_t"], history["motor"], history["pos_t"][:-1], 0.0)
+    moving = speed != 0
+    travel_rate = None
+    if moving.any():
+        slope = np.abs(np.diff(history["pos"]) / np.maximum(np.diff(history["pos_t"]), 1e-3))
+        travel_rate = float(np.median(slope[moving] / np.abs(speed[moving])))
+    return {"dt": dt, "gain": float(gain), "loss": float(loss), "offset": float(offset), "lag": lag * dt,
+            "mse": err, "travel_rate": travel_rate}
+
+def simulate(model: dict, options: dict, setpoints: np.ndarray, setpoint_dt: float,
+             temp0: float, pos0: float, params: dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Run the controller's PID against the room model, one PID period at a time.
+    Returns temperature, setpoint and actuator position per period.
+    """
+    settings = dict(options, **params)
+    period = float(settings["updaterate"])
+    steps = int(len(setpoints) * setpoint_dt // period)
+    # setpoint per PID period
+    sp = setpoints[np.minimum((np.arange(steps) * period / setpoint_dt).astype(int), len(setpoints) - 1)]
+    rate = model["travel_rate"] * abs(settings["speed"])
+    movetime = max(period - MOTOR_REST, 0.0)
+    margin = settings["posmargin"]
+    posmin, posmax = options["posmin"], options["posmax"]
+    lagsteps = int(round(model["lag"] / period))
+    decay = math.exp(-model["loss"] * period)
+
+    now = 0.0
+    pid = build_pid(settings, params["kp"], params["ki"], params["kd"], sp[0], time_fn=lambda: now)
+    # it is called exactly once per period here; with float periods the gap can come out a hair
+    # under sample_time, and the PID would then skip that update
+    pid.sample_time = None
+    temps = np.empty(steps)
+    positions = np.empty(steps)
+    valves = np.empty(steps)
+    temp, pos = temp0, pos0
+    for k in range(steps):
+        now = (k + 1) * period
+        pid.setpoint = sp[k]
+        target = pid(temp)
+        # MoveThread runs until it is within posmargin of the target
+        error = target - pos
+        if abs(error) > margin:
+            pos += math.copysign(min(abs(error) - margin, rate * movetime), error)
+        positions[k] = pos
+        valves[k] = (pos - posmin) / (posmax - posmin)
+        valve = valves[k - lagsteps] if k >= lagsteps else valves[0]
+        steady = (model["gain"] * valve + model["offset"]) / model["loss"]
+        temp = steady + (temp - steady) * decay
+        temps[k] = temp
+    return temps, sp, positions
+
+def score(temps: np.ndarray, sp: np.ndarray, positions: np.ndarray, period: float, band: float) -> Dict[str, float]:
+    """Overshoot (°C), mean settling time per setpoint (s) and total actuator travel."""
+    overshoot = float(max(np.max(temps - sp), 0.0)) if len(temps) else 0.0
+    changes = np.flatnonzero(np.diff(sp)) + 1
+    bounds = np.concatenate([[0], changes, [len(sp)]])
+    settle = []
+    outside = np.abs(temps - sp) > band
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        out = np.flatnonzero(outside[lo:hi])
+        settle.append((out[-1] + 1 if len(out) else 0) * period)
+    travel = float(np.sum(np.abs(np.diff(positions)))) if len(positions) > 1 else 0.0
+    return {"overshoot": overshoot, "settling": float(np.mean(settle)) if settle else 0.0, "travel": travel}
+
+# Worker state, set once per process by _init_worker so each task only pickles its parameters.
+_WORKER: dict = {}
+
+def _init_worker(model, options, setpoints, setpoint_dt, temp0, pos0, band):
+    _WORKER.update(model=model, options=options, setpoints=setpoints, setpoint_dt=setpoint_dt,
+                   temp0=temp0, pos0=pos0, band=band)
+
+def _run(params: dict) -> Tuple[dict, Dict[str, float]]:
+    w = _WORKER
+    temps, sp, positions = simulate(w["model"], w["options"], w["setpoints"], w["setpoint_dt"],
+                                    w["temp0"], w["pos0"], params)
+    return params, score(temps, sp, positions, float(params["updaterate"]), w["band"])
+
+def parse_range(text: str) -> List[float]:
+    if ":" in text:
+        start, stop, count = text.split(":")
+        return [float(v) for v in np.linspace(float(start), float(stop), int(count))]
+    return [float(v) for v in text.split(",")]
+
+def candidates(args, options: dict) -> List[dict]:
+    base = dict(DEFAULT_TUNINGS)
+    base.update({p: float(options[p]) for p in PARAMS if p in options})
+    ranges = {p: parse_range(getattr(args, p)) if getattr(args, p) else [base[p]] for p in PARAMS}
+    if args.random:
+        rng = random.Random(args.seed)
+        settings = [{p: rng.uniform(min(v), max(v)) for p, v in ranges.items()} for _ in range(args.random)]
+    else:
+        settings = [dict(zip(PARAMS, combo)) for combo in itertools.product(*(ranges[p] for p in PARAMS))]
+    for params in settings:
+        for p in INT_PARAMS:
+            params[p] = max(int(round(params[p])), 1)
+    # rounding can make grid points equal
+    unique = {tuple(params[p] for p in PARAMS): params for params in settings}
+    return list(unique.values())
+
+def rank(results: List[Tuple[dict, Dict[str, float]]]) -> List[Tuple[dict, Dict[str, float]]]:
+    """Order by the sum of each setting's rank on overshoot, settling time and travel."""
+    metrics = np.array([[r["overshoot"], r["settling"], r["travel"]] for _, r in results])
+    ranks = metrics.argsort(axis=0).argsort(axis=0).sum(axis=1)
+    return [results[i] for i in np.argsort(ranks, kind="stable")]
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    fit = sub.add_parser("fit", help="fit a room model to a trace")
+    fit.add_argument("trace")
+    fit.add_argument("model", help="where to write the fitted model (JSON)")
+    fit.add_argument("--options", default="/data/options.json")
+    fit.add_argument("--maxlag", type=float, default=1800.0, help="longest heating delay to consider (s)")
+    sweep = sub.add_parser("sweep", help="simulate and rank PID settings")
+    sweep.add_argument("trace")
+    sweep.add_argument("model", help="room model written by fit")
+    sweep.add_argument("--options", default="/data/options.json")
+    for p in PARAMS:
+        sweep.add_argument(f"--{p}", help="values, as a,b,c or start:stop:count")
+    sweep.add_argument("--random", type=int, default=0, help="sample this many settings from the ranges instead of the full grid")
+    sweep.add_argument("--seed", type=int, default=None)
+    sweep.add_argument("--setpoint", type=float, default=None, help="setpoint when the trace has none recorded")
+    sweep.add_argument("--band", type=float, default=0.3, help="settled when within this many °C of the setpoint")
+    sweep.add_argument("--jobs", type=int, default=os.cpu_count())
+    sweep.add_argument("--top", type=int, default=10)
+    sweep.add_argument("--output", help="write the ranked results here (JSON)")
+    args = parser.parse_args(argv)
+
+    with open(args.options) as f:
+        options = json.load(f)
+    history = load_history(args.trace)
+
+    if args.command == "fit":
+        model = fit_model(history, options, maxlag=args.maxlag)
+        with open(args.model, "w") as f:
+            json.dump(model, f, indent=2)
+        print(json.dumps(model, indent=2))
+        return 0
+
+    with open(args.model) as f:
+        model = json.load(f)
+    if not model.get("travel_rate"):
+        print("model has no actuator travel rate, the trace has no motor moves", file=sys.stderr)
+        return 1
+    setpoint_dt = 1.0
+    grid = np.arange(history["temp_t"][0], history["temp_t"][-1], setpoint_dt)
+    default = args.setpoint if args.setpoint is not None else float(options.get("min_temp", 20.0))
+    setpoints = step_values(history["setpoint_t"], history["setpoint"], grid, default)
+    todo = candidates(args, options)
+    print(f"simulating {len(todo)} settings over {len(grid) / 3600:.1f}h on {args.jobs} processes", file=sys.stderr)
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker,
+                             initargs=(model, options, setpoints, setpoint_dt, float(history["temp"][0]),
+                                       float(history["pos"][0]), args.band)) as pool:
+        results = list(pool.map(_run, todo, chunksize=max(len(todo) // (args.jobs * 4), 1)))
+    ranked = rank(results)
+
+    print(" ".join(f"{p:>10}" for p in PARAMS) + f" {'overshoot':>10} {'settling':>10} {'travel':>10}")
+    for params, result in ranked[:args.top]:
+        print(" ".join(f"{params[p]:10.4g}" for p in PARAMS)
+              + f" {result['overshoot']:10.2f} {result['settling']:10.0f} {result['travel']:10.0f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump([dict(params, **result) for params, result in ranked], f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())